@@ -18,11 +18,12 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(f'Cleaned: {begin_time}'))
         bulk_mgr = BulkCreateManager(chunk_size=100)
 
-        resps = [x for x in Response.objects.filter(
-            survey__name="Паспорт дома ДЗД")]
+        resps = Response.objects.filter(survey__name="Паспорт дома ДЗД")
 
-        answers = [x for x in Answer.objects
-                   .filter(response__in=resps, question__text="Адрес")]
+        answers = Answer.objects \
+            .filter(response__in=resps, question__text="Адрес") \
+            .select_related('response') \
+            .iterator(chunk_size=2000)
 
         for i, answer in enumerate(answers):
             req = json.dumps({"query": answer.body, "count": 1})
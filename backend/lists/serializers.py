@@ -1,23 +1,53 @@
-import base64
-import imghdr
+import binascii
+import copy
+import io
 import os
 import uuid
 from collections import defaultdict
+from functools import lru_cache
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.files import File
+from django.db.models import Count, Max, Prefetch
 from django.utils import timezone
 from django_q.tasks import async_task
 from rest_framework import serializers
 
-from notifications import tasks
 from user_profile import models as umodels
 
 from . import models
+from .tasks import update_mapnode
 
 
-class QuestionSerializer(serializers.ModelSerializer):
+@lru_cache(maxsize=None)
+def _response_content_type():
+    """ContentType row for Response, fetched at most once per process. """
+    return ContentType.objects.get_for_model(models.Response)
+
+
+REPORT_CACHE_TIMEOUT = 60 * 60
+
+
+class CachedFieldsModelSerializer(serializers.ModelSerializer):
+    """ModelSerializer that introspects the model only once per class.
+
+    get_fields() walks the model's fields and builds a serializer field
+    for each of them on every instantiation. The result only depends on
+    the class, so build it once, keep it on the class and hand out deep
+    copies (fields get bound to their serializer, so instances cannot
+    share them).
+    """
+
+    def get_fields(self):
+        cls = self.__class__
+        if '_fields_cache' not in cls.__dict__:
+            cls._fields_cache = super().get_fields()
+        return copy.deepcopy(cls._fields_cache)
+
+
+class QuestionSerializer(CachedFieldsModelSerializer):
     class Meta:
         model = models.Question
         fields = ('id', 'text', 'order', 'required',
@@ -44,26 +74,31 @@ class ReportSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'date_from', 'date_to', 'checklists')
 
 
-class AnswerSerializer(serializers.ModelSerializer):
-    question = QuestionSerializer()
+class AnswerSerializer(CachedFieldsModelSerializer):
+    # The full question payload already ships with the survey; answers
+    # only carry the id (plus the type scalar) to match against it.
+    question = serializers.PrimaryKeyRelatedField(read_only=True)
+    question_type = serializers.ChoiceField(
+        source='question.type',
+        choices=models.Question.QUESTION_TYPES,
+        read_only=True)
 
     class Meta:
         model = models.Answer
-        depth = 1
-        fields = ('id', 'question', 'body')
+        fields = ('id', 'question', 'question_type', 'body')
 
 
 class ResponseListSerializer(serializers.ModelSerializer):
     answers = AnswerSerializer(many=True)
-    user_text = serializers.SerializerMethodField()
+    # Annotated onto the queryset in the view (see views.USER_TEXT).
+    user_text = serializers.CharField(read_only=True)
 
-    def get_user_text(self, obj):
-        email = obj.user.email
-        if obj.user.first_name and obj.user.last_name:
-            res = f"{obj.user.first_name[0]}. {obj.user.last_name} <{email}>"
-        else:
-            res = email
-        return res
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Eager-load every relation this serializer touches, so views
+        serving it cannot forget one and reintroduce N+1 queries."""
+        return queryset.select_related('user', 'survey') \
+            .prefetch_related('answers__question')
 
     class Meta:
         model = models.Response
@@ -71,6 +106,17 @@ class ResponseListSerializer(serializers.ModelSerializer):
 
 
 class Base64ImageField(serializers.ImageField):
+    # Leading magic bytes per format; WEBP is special-cased because its
+    # marker sits at offset 8 of a RIFF container.
+    IMAGE_SIGNATURES = (
+        (b'\x89PNG\r\n\x1a\n', 'png'),
+        (b'\xff\xd8\xff', 'jpg'),
+        (b'GIF87a', 'gif'),
+        (b'GIF89a', 'gif'),
+    )
+
+    # Multiple of 4, so every chunk is a self-contained base64 unit.
+    B64_CHUNK_SIZE = 64 * 1024
 
     def to_internal_value(self, data):
         if isinstance(data, str):
@@ -79,31 +125,48 @@ class Base64ImageField(serializers.ImageField):
                 path = os.path.join(settings.MEDIA_ROOT,
                                     'files',
                                     complete_file_name)
-                with open(path, "rb") as imageFile:
-                    decoded_file = imageFile.read()
+                # Already on disk; let the storage stream it in chunks
+                # instead of pulling the whole file through memory.
+                data = File(open(path, "rb"), name=complete_file_name)
             elif 'data:' in data and ';base64,' in data:
                 header, data = data.split(';base64,')
-
-                try:
-                    decoded_file = base64.b64decode(data)
-                except TypeError:
-                    self.fail('invalid_image')
+                decoded_file = self.decode_base64(data)
 
                 file_name = str(uuid.uuid4())[:12]
                 file_extension = self.get_file_extension(
-                    file_name, decoded_file)
-
-                complete_file_name = f"{file_name}.{file_extension}"
+                    decoded_file.read(12))
+                decoded_file.seek(0)
 
-            data = ContentFile(decoded_file, name=complete_file_name)
+                data = File(decoded_file,
+                            name=f"{file_name}.{file_extension}")
 
         return super(Base64ImageField, self).to_internal_value(data)
 
-    def get_file_extension(self, file_name, decoded_file):
-        extension = imghdr.what(file_name, decoded_file)
-        extension = "jpg" if extension == "jpeg" else extension
-
-        return extension
+    def decode_base64(self, data):
+        """Decode in chunks rather than materializing input and output
+        side by side as one big str/bytes pair each."""
+        # b64decode used to discard whitespace anywhere in the payload
+        # (MIME-style wrapped base64); do the same up front, or the
+        # fixed-size slices lose their 4-char alignment.
+        data = "".join(data.split())
+        decoded_file = io.BytesIO()
+        try:
+            for start in range(0, len(data), self.B64_CHUNK_SIZE):
+                decoded_file.write(binascii.a2b_base64(
+                    data[start:start + self.B64_CHUNK_SIZE]))
+        except (TypeError, binascii.Error):
+            self.fail('invalid_image')
+
+        decoded_file.seek(0)
+        return decoded_file
+
+    def get_file_extension(self, header):
+        for signature, extension in self.IMAGE_SIGNATURES:
+            if header.startswith(signature):
+                return extension
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return 'webp'
+        return None
 
 
 class AttachmentSerializer(serializers.HyperlinkedModelSerializer):
@@ -114,7 +177,7 @@ class AttachmentSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('file', 'name')
 
 
-class ResponseSerializer(serializers.ModelSerializer):
+class ResponseSerializer(CachedFieldsModelSerializer):
     answers = AnswerSerializer(many=True)
     photo = AttachmentSerializer(many=True, required=False)
     user_text = serializers.SerializerMethodField()
@@ -137,14 +200,22 @@ class ResponseSerializer(serializers.ModelSerializer):
         photos = validated_data.pop('photo')
         response = models.Response.objects.create(**validated_data)
 
-        for answer in answers:
-            models.Answer.objects.create(response=response, **answer)
+        answer_objs = [models.Answer(response=response, **answer)
+                       for answer in answers]
+        models.Answer.objects.bulk_create(answer_objs, batch_size=500)
+
+        # bulk_create skips Answer.save(), so queue the mapnode update
+        # for address answers ourselves.
+        for answer in answer_objs:
+            if answer.question.type == models.Question.AUTOCOMPLETE_ADDRESS:
+                async_task(update_mapnode, answer)
 
-        content_type = ContentType.objects.get(model='response',
-                                               app_label='lists')
-        for photo in photos:
-            models.Attachment.objects.create(
-                object_id=response.id, content_type=content_type, **photo)
+        content_type = _response_content_type()
+        models.Attachment.objects.bulk_create(
+            [models.Attachment(object_id=response.id,
+                               content_type=content_type, **photo)
+             for photo in photos],
+            batch_size=500)
 
         return response
 
@@ -154,40 +225,55 @@ class ResponseSerializer(serializers.ModelSerializer):
         instance.survey = validated_data.get('survey', instance.survey)
 
         answers = self.initial_data['answers']
-        for answer in answers:
-            if answer.get('id', None):
-                ans = models.Answer.objects.get(id=answer['id'])
-                ans.body = answer['body']
-                ans.updated = timezone.now()
-                ans.save()
-            else:
-                models.Answer.objects.create(
-                    question=answer['question'],
-                    response=instance,
-                    body=answer["body"],
-                    created=timezone.now(),
-                    updated=timezone.now(),
-                )
-
-        instance.photo.all().delete()
+        existing = {answer['id']: answer
+                    for answer in answers if answer.get('id', None)}
+        updated_answers = []
+        if existing:
+            updated_answers = list(models.Answer.objects
+                                   .filter(id__in=existing)
+                                   .select_related('question'))
+            now = timezone.now()
+            for ans in updated_answers:
+                ans.body = existing[ans.id]['body']
+                ans.updated = now
+            models.Answer.objects.bulk_update(updated_answers,
+                                              ['body', 'updated'])
+
+        new_answers = [models.Answer(question=answer['question'],
+                                     response=instance,
+                                     body=answer['body'])
+                       for answer in answers if not answer.get('id', None)]
+        models.Answer.objects.bulk_create(new_answers, batch_size=500)
+
+        # Same compensation as in create(): the bulk writes skip
+        # Answer.save(), which is what re-geocodes address answers.
+        for answer in updated_answers + new_answers:
+            if answer.question.type == models.Question.AUTOCOMPLETE_ADDRESS:
+                async_task(update_mapnode, answer)
+
+        content_type = _response_content_type()
+        # Not _raw_delete: the pre_delete receiver on Attachment removes
+        # the files from disk and still has to fire.
+        models.Attachment.objects.filter(
+            content_type=content_type, object_id=instance.id).delete()
 
         photos = validated_data.get('photo', [])
-        content_type = ContentType.objects.get(model='response',
-                                               app_label='lists')
-        for photo in photos:
-            models.Attachment.objects.create(
-                object_id=instance.id, content_type=content_type, **photo)
-        async_task(tasks.basic_report, instance)
+        models.Attachment.objects.bulk_create(
+            [models.Attachment(object_id=instance.id,
+                               content_type=content_type, **photo)
+             for photo in photos],
+            batch_size=500)
         return instance
 
     def validate(self, attrs):
-        in_survey_count = len(
-            [x for x in attrs['survey'].questions.all() if x.required is True])
+        in_survey_count = attrs['survey'].questions \
+            .filter(required=True).count()
 
-        in_response_count = len(
-            [x for x in attrs['answers'] if x['question']['required'] is True])
+        in_response_count = sum(
+            1 for x in self.initial_data['answers']
+            if x['question'].get('required'))
 
-        if attrs['photo'] is not []:
+        if attrs.get('photo'):
             in_response_count += 1
 
         if in_response_count < in_survey_count:
@@ -214,51 +300,32 @@ class MapNodeSerializer(serializers.ModelSerializer):
 # Begin report generation
 
 
-class ReportQuestionSerializer(serializers.ModelSerializer):
+class ReportQuestionSerializer(CachedFieldsModelSerializer):
     def __init__(self, *args, **kwargs):
         self.responses = kwargs.pop('responses', None)
-        self.answers = kwargs.pop('answers', None)
-        self.photos = kwargs.pop('photos', None)
-        self.questions = kwargs.pop('questions', None)
+        self.answers_by_question = kwargs.pop('answers_by_question', None)
+        self.keys_by_response = kwargs.pop('keys_by_response', None)
         super(ReportQuestionSerializer, self).__init__(*args, **kwargs)
 
     notes = serializers.SerializerMethodField()
     answer = serializers.SerializerMethodField()
 
     def get_answer(self, obj):
-        dict_response_answers = defaultdict(list)
-        for x in self.answers:
-            dict_response_answers[x.response_id].append(x)
         for response in self.responses:
-            response_answers = dict_response_answers[response.id]
-            for answer in [x for x in response_answers
-                           if x.question_id is obj.id]:
+            for answer in self.answers_by_question.get(
+                    (response.id, obj.id), ()):
                 return answer.body
 
     def get_notes(self, obj):
         key_choices = obj.key_choices.split(";")
         notes = []
 
-        dict_response_answers = defaultdict(list)
-        for x in self.answers:
-            dict_response_answers[x.response_id].append(x)
-
         for response in self.responses:
-            response_answers = dict_response_answers[response.id]
-
-            keys = [{"name": question.text, "answer": answer.body}
-                    for question in self.questions
-                    for answer in [x for x in response_answers
-                                   if x.question_id is question.id]
-                    ]
-
-            for k in self.photos:
-                keys.append({"name": "image", "keys": k.file.url})
-
-            for answer in [x for x in response_answers
-                           if x.question_id is obj.id]:
+            for answer in self.answers_by_question.get(
+                    (response.id, obj.id), ()):
                 if answer.body in key_choices:
-                    notes.append({"created": response.created, "keys": keys})
+                    notes.append({"created": response.created,
+                                  "keys": self.keys_by_response[response.id]})
 
         return notes
 
@@ -269,40 +336,41 @@ class ReportQuestionSerializer(serializers.ModelSerializer):
 
 
 class ReportSurveySerializer(serializers.ModelSerializer):
-    def __init__(self, *args, **kwargs):
-        self.responses = kwargs.pop('responses', None)
-        self.answers = kwargs.pop('answers', None)
-        self.questions = kwargs.pop('questions', None)
-        super(ReportSurveySerializer, self).__init__(*args, **kwargs)
-
     questions = serializers.SerializerMethodField()
 
     def get_questions(self, obj):
-        que = [x for x in self.questions
-               if (x.survey_id is obj.id) and (x.type != 'select-image')]
-
         dict_que = defaultdict(list)
-        for x in que:
-            dict_que[x.is_key].append(x)
-
-        answers = [x for x in self.answers
-                   for qu in que
-                   if x.question_id is qu.id]
+        que_ids = set()
+        for question in obj.questions.all():
+            if question.type != 'select-image':
+                dict_que[question.is_key].append(question)
+                que_ids.add(question.id)
+
+        responses = list(obj.responses.all())
+        answers_by_question = defaultdict(list)
+        for response in responses:
+            for answer in response.answers.all():
+                if answer.question_id in que_ids:
+                    answers_by_question[(response.id, answer.question_id)] \
+                        .append(answer)
+
+        keys_by_response = {}
+        for response in responses:
+            keys = [{"name": question.text, "answer": answer.body}
+                    for question in dict_que[True]
+                    for answer in answers_by_question.get(
+                        (response.id, question.id), ())
+                    ]
 
-        resps = [x for x in self.responses
-                 if x.survey_id is obj.id]
+            for k in response.photo.all():
+                keys.append({"name": "image", "keys": k.file.url})
 
-        resps_id = [x.id for x in resps]
-        response_type_id = ContentType.objects.get_for_model(models.Response)
-        photos = [x for x in models.Attachment.objects.filter(
-            content_type_id=response_type_id,
-            object_id__in=resps_id)]
+            keys_by_response[response.id] = keys
 
         return ReportQuestionSerializer(dict_que[False],
-                                        responses=resps,
-                                        answers=answers,
-                                        questions=dict_que[True],
-                                        photos=photos,
+                                        responses=responses,
+                                        answers_by_question=answers_by_question,
+                                        keys_by_response=keys_by_response,
                                         many=True).data
 
     class Meta:
@@ -314,28 +382,40 @@ class ReportGetEntitySerializer(serializers.ModelSerializer):
     checklists = serializers.SerializerMethodField()
 
     def get_checklists(self, obj):
-        lists = [x for x in obj.checklists.all().only('name')]
-
-        resps = [x for x in models.Response.objects
-                 .filter(survey__in=lists,
-                         created__range=[obj.date_from, obj.date_to])
-                 .only('created', 'survey_id')
-                 ]
-
-        answers = [x for x in models.Answer.objects
-                   .filter(response__in=resps)
-                   .only('body', 'question_id', 'response_id')
-                   ]
-
-        questions = [x for x in models.Question.objects
-                     .filter(survey__in=lists).order_by()
-                     ]
-
-        return ReportSurveySerializer(lists,
-                                      responses=resps,
-                                      answers=answers,
-                                      questions=questions,
-                                      many=True).data
+        # Key the cache on the data's own state: response updates always
+        # rewrite their answers' updated stamps, creations add answers
+        # and deletions change the count, so any write moves the key -
+        # regardless of which worker process handled it.
+        state = models.Response.objects \
+            .filter(survey__in=obj.checklists.all(),
+                    created__range=[obj.date_from, obj.date_to]) \
+            .aggregate(count=Count('id'), changed=Max('answers__updated'))
+        changed = state['changed']
+        key = (f"report:{obj.id}:{obj.date_from.isoformat()}"
+               f":{obj.date_to.isoformat()}:{state['count']}"
+               f":{changed.isoformat() if changed else None}")
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+        responses = models.Response.objects \
+            .filter(created__range=[obj.date_from, obj.date_to]) \
+            .only('created', 'survey_id')
+
+        lists = obj.checklists.prefetch_related(
+            Prefetch('responses', queryset=responses),
+            Prefetch('responses__answers',
+                     queryset=models.Answer.objects
+                     .only('body', 'question_id', 'response_id')),
+            Prefetch('responses__photo',
+                     queryset=models.Attachment.objects
+                     .only('file', 'object_id', 'content_type_id')),
+            'questions',
+        )
+
+        data = ReportSurveySerializer(lists, many=True).data
+        cache.set(key, data, REPORT_CACHE_TIMEOUT)
+        return data
 
     class Meta:
         model = models.Report
@@ -1,3 +1,7 @@
+from django.db.models import Case, CharField, F, Value, When
+from django.db.models.functions import Concat, Substr
+from django.utils import timezone
+from django_q.models import Schedule
 from rest_framework.mixins import ListModelMixin, RetrieveModelMixin, \
     CreateModelMixin, UpdateModelMixin, DestroyModelMixin
 from rest_framework.permissions import IsAdminUser, AllowAny
@@ -6,7 +10,18 @@ from rest_framework.viewsets import GenericViewSet
 from rest_framework.pagination import PageNumberPagination
 
 from . import models, serializers
-from datetime import datetime
+from datetime import datetime, timedelta
+
+# SQL version of the old get_user_text serializer method:
+# "F. Lastname <email>", or just the email if either name is empty.
+USER_TEXT = Case(
+    When(user__first_name='', then=F('user__email')),
+    When(user__last_name='', then=F('user__email')),
+    default=Concat(Substr('user__first_name', 1, 1), Value('. '),
+                   F('user__last_name'), Value(' <'),
+                   F('user__email'), Value('>')),
+    output_field=CharField(),
+)
 
 
 class SurveyListViewset(GenericViewSet, ListModelMixin):
@@ -15,17 +30,16 @@ class SurveyListViewset(GenericViewSet, ListModelMixin):
 
 
 class ResponseListViewset(GenericViewSet, ListModelMixin):
-    queryset = models.Response.objects.prefetch_related(
-        'answers', 'answers__question', 'user').all()
+    queryset = serializers.ResponseListSerializer.setup_eager_loading(
+        models.Response.objects.all()).annotate(user_text=USER_TEXT)
     serializer_class = serializers.ResponseListSerializer
 
     def list(self, request, *args, **kwargs):
         self.pagination_class = PageNumberPagination
         self.page_size = 20
         self.pagination_class.page_size = 20
-        queryset = models.Response.objects \
-            .prefetch_related('answers', 'answers__question', 'user') \
-            .all()
+        queryset = serializers.ResponseListSerializer.setup_eager_loading(
+            models.Response.objects.all()).annotate(user_text=USER_TEXT)
         fr = request.query_params.get("from", None)
         if (fr):
             queryset = queryset.filter(
@@ -65,6 +79,20 @@ class ResponseViewset(GenericViewSet, CreateModelMixin,
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def perform_update(self, serializer):
+        instance = serializer.save()
+        # A burst of edits to the same response triggers one report,
+        # delayed so it observes the last save of the burst. The pending
+        # Schedule row lives in the database, so the dedup holds across
+        # worker processes, and the ONCE schedule deletes itself after
+        # running.
+        Schedule.objects.get_or_create(
+            func='notifications.tasks.basic_report_by_id',
+            args=str((instance.id,)),
+            schedule_type=Schedule.ONCE,
+            defaults={'next_run': timezone.now() + timedelta(seconds=5)},
+        )
+
 # Report viewsets
 
 
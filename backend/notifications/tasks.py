@@ -13,6 +13,15 @@ def get_user_text(obj):
     return res
 
 
+def basic_report_by_id(response_id):
+    """Entry point for scheduled runs: re-read the response so a delayed
+    task reports its state at execution time, not at queueing time."""
+    from lists.models import Response
+    response = Response.objects.filter(pk=response_id).first()
+    if response is not None:
+        basic_report(response)
+
+
 def basic_report(response):
     from .models import Subscription
     subscriptions = Subscription.objects.filter(
@@ -26,22 +35,21 @@ def basic_report(response):
     if not dests:
         return
 
-    from lists.models import Answer
-    from lists.models import Question
-    answers = [x for x in Answer.objects
-               .filter(response=response)
-               .only('body', 'question_id', 'response_id')
-               ]
-
-    questions = [x for x in Question.objects
-                 .filter(survey=response.survey).order_by()
-                 ]
+    from django.db.models import Prefetch
+    from lists.models import Answer, Attachment, Response, Survey
+    survey = Survey.objects.filter(pk=response.survey_id).prefetch_related(
+        Prefetch('responses', queryset=Response.objects.filter(pk=response.pk)),
+        Prefetch('responses__answers',
+                 queryset=Answer.objects
+                 .only('body', 'question_id', 'response_id')),
+        Prefetch('responses__photo',
+                 queryset=Attachment.objects
+                 .only('file', 'object_id', 'content_type_id')),
+        'questions',
+    )
 
     from lists import serializers
-    report = serializers.ReportSurveySerializer([response.survey],
-                                                responses=[response],
-                                                answers=answers,
-                                                questions=questions,
+    report = serializers.ReportSurveySerializer(survey,
                                                 many=True).data[0]
     report["created"] = response.created
     report["updated"] = response.updated
@@ -50,7 +58,7 @@ def basic_report(response):
 
     fl = True
     for question in report["questions"]:
-        if question["notes"] is not None and question["notes"] is not []:
+        if question["notes"]:
             fl = False
 
     if fl:
@@ -20,7 +20,7 @@ export default {
 
       for (const { question } of questions) {
         if (question.type !== 'select-image') {
-          const answer = data.answers.find(answer => question.id === answer.question.id)
+          const answer = data.answers.find(answer => question.id === answer.question)
           if (answer) {
             answers[question.id] = {
               body: answer.body,